@@ -1,21 +1,108 @@
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from PIL import Image, ImageDraw
+from PIL import Image
 import cv2
 
 from image_annotation import *
 
-def overlay_masks_on_image(pil_image, masks, mask_colors=[], transparency=0.5, thickness=1, borders=True):
+def mask_contours(mask, borders=True):
+    """
+    Finds the external contours of a mask over its whole bounding box, in
+    full image coordinates. Only the bounding box is found if `borders` is False.
+
+    Returns:
+        tuple: The (x0, y0, x1, y1) bounding box of the mask, or None for an
+            empty mask, and the list of contours.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None, []
+    cols = np.flatnonzero(mask.any(axis=0))
+
+    x0, y0, x1, y1 = cols[0], rows[0], cols[-1] + 1, rows[-1] + 1
+    if not borders:
+        return (x0, y0, x1, y1), []
+
+    contours, _ = cv2.findContours(
+        mask[y0:y1, x0:x1].astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=(int(x0), int(y0))
+    )
+
+    return (x0, y0, x1, y1), contours
+
+
+def render_overlay_tile(masks, fill_colors, mask_boxes, contours, tile_box, halo, transparency=0.5, thickness=1, borders=True):
+    """
+    Renders the mask fills and borders of one tile of the overlay.
+
+    The contours are found beforehand over each whole mask (see
+    `mask_contours`), so a tile edge never adds a border. The tile is drawn
+    with `halo` extra pixels on each side, so the lines that cross its edges
+    are rasterized as in a full-frame render; the halo is cropped away
+    before returning.
+
+    Args:
+        masks (list): List of boolean masks with the size of the full image.
+        fill_colors (list): RGB fill color of each mask.
+        mask_boxes (list): Bounding box of each mask, None for empty masks.
+        contours (list): Contours of each mask, in full image coordinates.
+        tile_box (tuple): (x0, y0, x1, y1) of the tile in the full image.
+        halo (int): Number of overlapping pixels around the tile.
+
+    Returns:
+        np.ndarray: RGBA overlay of the tile, of shape (y1 - y0, x1 - x0, 4).
+    """
+    x0, y0, x1, y1 = tile_box
+    height, width = masks[0].shape[:2]
+
+    # Tile with halo, clipped to the image
+    hx0, hy0 = max(x0 - halo, 0), max(y0 - halo, 0)
+    hx1, hy1 = min(x1 + halo, width), min(y1 + halo, height)
+
+    overlay = np.zeros((hy1 - hy0, hx1 - hx0, 4), dtype=np.uint8)
+    border_color = (0, 0, 255, int(255 * 0.4))
+
+    for mask, fill_color, mask_box, mask_contour in zip(masks, fill_colors, mask_boxes, contours):
+        if mask_box is None:
+            continue
+        bx0, by0, bx1, by1 = mask_box
+        if bx0 >= hx1 or bx1 <= hx0 or by0 >= hy1 or by1 <= hy0:
+            continue
+
+        mask_crop = np.asarray(mask[hy0:hy1, hx0:hx1], dtype=bool)
+        overlay[mask_crop] = (*[int(c) for c in fill_color], int(255 * transparency))
+
+        if borders:
+            # Draw borders. The contours are drawn pixel by pixel: merging straight
+            # runs into longer segments changes how thick lines are rasterized
+            # when a tile cuts the run
+            shifted = [contour - np.array([hx0, hy0], dtype=contour.dtype) for contour in mask_contour]
+            cv2.polylines(overlay, shifted, isClosed=True, color=border_color, thickness=thickness)
+
+    return overlay[y0 - hy0:y1 - hy0, x0 - hx0:x1 - hx0]
+
+
+def overlay_masks_on_image(pil_image, masks, mask_colors=[], transparency=0.5, thickness=1, borders=True, tile_size=1024, max_workers=None):
     """
     Overlay annotations on a PIL image and return the modified image.
 
+    The contours of the masks are found in a thread pool, one mask per task.
+    Then the image is split in tiles of `tile_size` pixels that are rendered
+    in the same pool and stitched together. OpenCV and NumPy release the GIL,
+    so the overlay of large images scales with the number of cores.
+
     Args:
         pil_image (PIL.Image.Image): The input image.
-        anns (list): List of annotation dictionaries. Each dictionary should contain a 'segmentation' key with a boolean mask.
+        masks (list): List of boolean masks with the size of the image.
         mask_colors (list): List of colors for the masks in RGB format. Defaults to green for all masks.
         transparency (float): Transparency of the overlay masks (0 to 1).
         thickness (int): Thickness of the border lines.
         borders (bool): Whether to draw borders around the masks.
+        tile_size (int): Side of the square tiles, in pixels.
+        max_workers (int): Number of threads. Defaults to the number of cores.
 
     Returns:
         PIL.Image.Image: The image with annotations overlayed.
@@ -29,30 +116,195 @@ def overlay_masks_on_image(pil_image, masks, mask_colors=[], transparency=0.5, t
 
     # Convert PIL image to RGBA if not already in that mode
     img = pil_image.convert("RGBA")
-    overlay = Image.new("RGBA", img.size, (255, 255, 255, 0))
+    width, height = img.size
 
-    for mask, fill_color in zip(masks, mask_colors):
-        fill_color = [int(c) for c in fill_color]
-        rgba_fill = (*fill_color, int(255 * transparency))
-        # Create a mask image from the segmentation
-        mask = Image.fromarray((mask * 255).astype(np.uint8), mode="L")
-        overlay.paste(Image.new("RGBA", img.size, rgba_fill), mask=mask)
+    # Overlapping pixels needed for the borders to match across tiles
+    halo = 2 * thickness + 2
 
-        if borders:
-            # Draw borders
-            contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-            contours = [cv2.approxPolyDP(contour, epsilon=0.01, closed=True) for contour in contours]
-            draw = ImageDraw.Draw(overlay)
-            for contour in contours:
-                points = [tuple(pt[0]) for pt in contour]
-                draw.line(points + [points[0]], fill=(0, 0, 255, int(255 * 0.4)), width=thickness)
+    tile_boxes = [
+        (x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height))
+        for y0 in range(0, height, tile_size)
+        for x0 in range(0, width, tile_size)
+    ]
+
+    overlay = np.zeros((height, width, 4), dtype=np.uint8)
+
+    workers = max_workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        mask_boxes, contours = zip(*executor.map(lambda mask: mask_contours(mask, borders), masks))
+
+        def render(tile_box):
+            x0, y0, x1, y1 = tile_box
+            overlay[y0:y1, x0:x1] = render_overlay_tile(
+                masks, mask_colors, mask_boxes, contours, tile_box, halo, transparency, thickness, borders
+            )
+
+        list(executor.map(render, tile_boxes))
 
     # Combine the original image with the overlay
-    combined = Image.alpha_composite(img, overlay)
+    combined = Image.alpha_composite(img, Image.fromarray(overlay, mode="RGBA"))
     return combined
 
 
 
+def read_label_image(mask_bytes):
+    """
+    Reads a segmentation from the bytes of a tif file.
+
+    A single page is taken as a label image (0 for background, k for the k-th
+    instance, ids do not need to be consecutive), unless it only holds the
+    values 0 and 255: then it is a binary mask and each connected component
+    is an instance. Several pages are taken as one binary mask per instance.
+
+    Returns:
+        np.ndarray: Label image of shape (height, width).
+    """
+    buffer = np.frombuffer(mask_bytes, dtype=np.uint8)
+    success, pages = cv2.imdecodemulti(buffer, cv2.IMREAD_UNCHANGED)
+    if not success or len(pages) == 0:
+        raise ValueError("Could not read the mask file")
+
+    if len(pages) == 1:
+        label_image = pages[0]
+        if label_image.ndim == 3:
+            label_image = label_image[..., 0]
+
+        if np.isin(label_image, (0, 255)).all():
+            _, label_image = cv2.connectedComponents((label_image > 0).astype(np.uint8))
+
+        return label_image.astype(np.int32)
+
+    return masks_to_label_image([page > 0 for page in pages])
+
+
+def masks_to_label_image(masks):
+    """
+    Converts a list of boolean masks into a label image where the pixels of
+    the i-th mask have value i + 1. Overlapping pixels keep the last mask.
+    """
+    label_image = np.zeros(masks[0].shape[:2], dtype=np.int32)
+    for mask_id, mask in enumerate(masks, start=1):
+        label_image[np.asarray(mask, dtype=bool)] = mask_id
+
+    return label_image
+
+
+def point_mask_ids(label_image, points):
+    """
+    Returns the mask id under each point by indexing the label image with the
+    coordinate arrays. Points on the image border are clipped inside it.
+
+    Args:
+        label_image (np.ndarray): Label image of shape (height, width).
+        points (np.ndarray): Array of shape (N, 2) with the (x, y) coordinates.
+    """
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    height, width = label_image.shape[:2]
+    x = np.clip(points[:, 0], 0, width - 1)
+    y = np.clip(points[:, 1], 0, height - 1)
+
+    return label_image[y, x]
+
+
+def count_points_per_mask(label_image, points, labels, weights=None, num_masks=None):
+    """
+    Counts the points of each label that fall inside each mask.
+
+    Returns:
+        np.ndarray: Array of shape (num_masks + 1, len(label_list)); row 0
+            holds the points that fall on the background.
+    """
+    if num_masks is None:
+        num_masks = int(label_image.max())
+    num_labels = len(label_list)
+
+    mask_ids = point_mask_ids(label_image, points)
+    labels = np.asarray(labels, dtype=np.int64)
+    counts = np.bincount(
+        mask_ids * num_labels + labels,
+        weights=weights,
+        minlength=(num_masks + 1) * num_labels,
+    )
+
+    return counts.reshape(num_masks + 1, num_labels).astype(np.int64)
+
+
+def points_to_arrays(point_labels):
+    """
+    Converts an iterable of ((x, y), label) pairs into coordinate and label arrays.
+    """
+    point_labels = list(point_labels)
+    points = np.array([point for point, _ in point_labels], dtype=np.int64).reshape(-1, 2)
+    labels = np.array([label for _, label in point_labels], dtype=np.int64)
+
+    return points, labels
+
+
+def get_mask_ids(label_image):
+    """
+    Returns the ids of the masks present in the label image, without the background.
+    """
+    return np.flatnonzero(np.bincount(label_image.ravel())[1:]) + 1
+
+
+def flag_masks(mask_counts, mask_ids):
+    """
+    Flags the masks with no points and the masks with points of more than one label.
+
+    Args:
+        mask_counts (np.ndarray): Per-mask label counts from `count_points_per_mask`.
+        mask_ids (np.ndarray): Ids of the masks present in the label image.
+
+    Returns:
+        tuple: Ids of the empty masks and ids of the masks with conflicting labels.
+    """
+    counts = mask_counts[mask_ids]
+    empty_masks = mask_ids[counts.sum(axis=1) == 0]
+    conflicting_masks = mask_ids[(counts > 0).sum(axis=1) > 1]
+
+    return empty_masks, conflicting_masks
+
+
+def update_mask_association(session_state, label_image, all_points, all_labels, mask_ids=None):
+    """
+    Updates the per-mask label counts in the session state.
+
+    When only the latest edit recorded by `record_point_changes` is missing,
+    just its added and removed points are looked up in the label image.
+    Otherwise the counts are built again from all the points. Only the ids in
+    `mask_ids` (by default, the ones present in the label image) are flagged.
+    """
+    num_masks = int(label_image.max())
+    if mask_ids is None:
+        mask_ids = get_mask_ids(label_image)
+    changes = session_state.get('point_changes', {'version': 0, 'added': None, 'removed': None})
+    counts_version = session_state.get('mask_counts_version')
+
+    if 'mask_counts' not in session_state or session_state['mask_counts'].shape[0] != num_masks + 1:
+        counts_version = None
+
+    if counts_version == changes['version']:
+        return session_state['mask_counts']
+
+    if counts_version == changes['version'] - 1 and changes['added'] is not None:
+        added, removed = changes['added'], changes['removed']
+        if len(added) + len(removed) > 0:
+            points, labels = points_to_arrays(list(added.items()) + list(removed.items()))
+            weights = np.concatenate([np.ones(len(added)), -np.ones(len(removed))])
+            session_state['mask_counts'] = session_state['mask_counts'] + count_points_per_mask(
+                label_image, points, labels, weights=weights, num_masks=num_masks
+            )
+
+    else:
+        points, labels = points_to_arrays(all_labels.items())
+        session_state['mask_counts'] = count_points_per_mask(label_image, points, labels, num_masks=num_masks)
+
+    session_state['mask_counts_version'] = changes['version']
+    session_state['empty_masks'], session_state['conflicting_masks'] = flag_masks(session_state['mask_counts'], mask_ids)
+
+    return session_state['mask_counts']
+
+
 def ann_correction(session_state):
 
     st.sidebar.header("Seleccionar zoom")
@@ -75,6 +327,11 @@ def ann_correction(session_state):
         with col2:
             session_state['label'] = st.selectbox("Clase:", label_list)
 
+        if REGION_MODES:
+            session_state['region_shape'] = st.selectbox("Región:", region_shapes)
+        else:
+            session_state['region_shape'] = region_shapes[0]
+
     if 'image_file_name' in session_state:
         st.sidebar.header("Resultados")
         # Sidebar buttons
@@ -159,13 +416,11 @@ def ann_correction(session_state):
             recover_session(session_state, all_points, all_labels, image, image_file_name[:-4])
 
 
-        update_patch_data(session_state)
+        all_points = session_state['all_points']
+        all_labels = session_state['all_labels']
+        update_patch_data(session_state, all_points, all_labels)
 
-        action = session_state['action']
-        if action == actions[1]:
-            mode = 'Del'
-        else:
-            mode = 'Transform'
+        mode = action_modes[session_state['action']]
                     
         # Use pointdet to annotate the image
         new_labels = pointdet(
@@ -181,10 +436,39 @@ def ann_correction(session_state):
             label = session_state['label'],
             point_width=5,
             zoom=zoom,
+            region_shape = 'polygon' if session_state['region_shape'] == region_shapes[1] else 'rect',
         )
         
         # Update points and labels in session state if any changes are made
-        if new_labels is not None:
-            update_annotations(new_labels, session_state)
-            update_results(session_state, image_file_name[:-4])
-            update_ann_image(session_state, image)
+        all_points, all_labels = handle_component_value(session_state, new_labels, all_points, all_labels, image, image_file_name[:-4])
+        show_region_counts(session_state)
+
+        # Associate the points with the segmentation masks
+        if uploaded_mask_file is not None:
+            # The id changes with every upload, even if the file name is the same
+            if session_state.get('mask_file_id') != uploaded_mask_file.id:
+                session_state['label_image'] = read_label_image(uploaded_mask_file.getvalue())
+                session_state['mask_ids'] = get_mask_ids(session_state['label_image'])
+                session_state['mask_file_id'] = uploaded_mask_file.id
+                session_state.pop('mask_counts', None)
+
+            if session_state['label_image'].shape[:2] != (height, width):
+                mask_height, mask_width = session_state['label_image'].shape[:2]
+                st.error(
+                    f"Las máscaras ({mask_width}x{mask_height}) no tienen el tamaño "
+                    f"de la imagen ({width}x{height})."
+                )
+
+            else:
+                update_mask_association(
+                    session_state, session_state['label_image'], all_points, all_labels, session_state['mask_ids']
+                )
+
+                empty_masks = ", ".join(str(mask_id) for mask_id in session_state['empty_masks'])
+                conflicting_masks = ", ".join(str(mask_id) for mask_id in session_state['conflicting_masks'])
+
+                st.sidebar.header("Máscaras")
+                with st.sidebar:
+                    st.write(f"Cantidad de máscaras: {len(session_state['mask_ids'])}")
+                    st.write(f"Máscaras sin puntos ({len(session_state['empty_masks'])}): {empty_masks or '-'}")
+                    st.write(f"Máscaras con clases en conflicto ({len(session_state['conflicting_masks'])}): {conflicting_masks or '-'}")
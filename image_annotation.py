@@ -1,21 +1,46 @@
 import streamlit as st
-from streamlit_image_annotation import pointdet
+from streamlit_image_annotation import pointdet, REGION_MODES
 import io
 import csv
+import json
+import zipfile
+import tempfile
+from itertools import compress
 from PIL import Image
 from PIL import Image, ImageDraw
 import numpy as np
 import pandas as pd
 import os
+from matplotlib.path import Path
 
 # Folders
 image_dir  = "./images"
 ann_dir    = "./annotations"
 report_dir = "./reports"
+export_dir = "./exports"
 
 # Define label list
 label_list = ['Positivo', 'Negativo', 'No importante']
 actions = ['Agregar', 'Borrar']
+if REGION_MODES:
+    actions += ['Reetiquetar región', 'Borrar región', 'Contar en región']
+region_shapes = ['Rectángulo', 'Polígono']
+
+# pointdet modes for each action
+action_modes = {
+    'Agregar': 'Transform',
+    'Borrar': 'Del',
+    'Reetiquetar región': 'Relabel',
+    'Borrar región': 'DelRegion',
+    'Contar en región': 'Count',
+}
+
+# Region operation sent back by pointdet for each region mode
+mode_region_operations = {
+    'Relabel': 'relabel',
+    'DelRegion': 'delete',
+    'Count': 'count',
+}
 
 def init_session(session_state):
 
@@ -26,6 +51,20 @@ def init_session(session_state):
     session_state['csv_data'] = b""
     session_state['report_data'] = b""
     session_state['ann_image'] = b"" 
+    record_point_changes(session_state, None, None)
+
+
+def record_point_changes(session_state, added, removed):
+    """
+    Stores the points added and removed by the latest edit, as dictionaries
+    mapping each point to its label. A relabeled point appears in both with
+    its new and old label. `None` means the whole set of points was replaced.
+
+    Each call increases a version number, so readers can tell whether they
+    missed an edit.
+    """
+    version = session_state.get('point_changes', {}).get('version', 0) + 1
+    session_state['point_changes'] = {'version': version, 'added': added, 'removed': removed}
 
 
 def update_patch_data(session_state, all_points, all_labels):
@@ -93,6 +132,7 @@ def update_results(session_state, all_points, all_labels, file_name):
 def update_annotations(new_labels, all_points, all_labels, session_state):
 
     patch_points = []
+    previous_labels = {}  # Label of each patch point before the update, None for new points
 
     # Add new points
     for v in new_labels:
@@ -106,49 +146,47 @@ def update_annotations(new_labels, all_points, all_labels, session_state):
 
         point_tuple = (x, y)
 
+        if point_tuple not in previous_labels:
+            previous_labels[point_tuple] = all_labels.get(point_tuple)
+
         if point_tuple not in all_points:
             all_points.add(point_tuple)
-            all_labels[point_tuple] = label_id  # Store the label for this point
-
-    # Remove points
-    removed_points = []
-    for global_point in all_points:
-        x, y = global_point
-
-        remove_flag = True
-
-        for patch_point in patch_points:
 
-            x_patch, y_patch = patch_point
-
-            nequal_flag = not ( (x == x_patch) and (y == y_patch) )
-
-            remove_flag = remove_flag and nequal_flag
-
-        if remove_flag:
-            removed_points.append(global_point)
+        all_labels[point_tuple] = label_id  # Store the label for this point
 
+    # Remove points
+    removed_points = all_points - set(map(tuple, patch_points))
+    removed = {point: all_labels[point] for point in removed_points}
 
     for removed_point in removed_points:
         all_points.remove(removed_point)
         del all_labels[removed_point]  # Remove the corresponding label
 
+    # Keep track of the added and relabeled points
+    added = {}
+    for point, previous_label in previous_labels.items():
+        if previous_label != all_labels[point]:
+            added[point] = all_labels[point]
+            if previous_label is not None:
+                removed[point] = previous_label
+
+    record_point_changes(session_state, added, removed)
+
     session_state['all_points'] = all_points
     session_state['all_labels'] = all_labels
 
     return all_points, all_labels
 
 
-def update_ann_image(session_state, all_points, all_labels, image):
+def draw_points_on_image(image, all_points, all_labels):
     """
-    Overlays points on the image with colors corresponding to their labels 
-    and stores the result in the session state for display and download.
+    Returns a copy of the image with the points drawn as circles with colors
+    corresponding to their labels.
 
     Args:
-        session_state: dict containing `all_points` and `all_labels`.
-            - `all_points`: List of tuples representing points (x, y).
-            - `all_labels`: Dictionary mapping points to labels.
         image: PIL.Image object representing the base image.
+        all_points: List of tuples representing points (x, y).
+        all_labels: Dictionary mapping points to labels.
     """
 
     # Define colors for each label
@@ -177,6 +215,23 @@ def update_ann_image(session_state, all_points, all_labels, image):
             width=5,
         )
 
+    return ann_image
+
+
+def update_ann_image(session_state, all_points, all_labels, image):
+    """
+    Overlays points on the image with colors corresponding to their labels 
+    and stores the result in the session state for display and download.
+
+    Args:
+        session_state: dict containing `all_points` and `all_labels`.
+            - `all_points`: List of tuples representing points (x, y).
+            - `all_labels`: Dictionary mapping points to labels.
+        image: PIL.Image object representing the base image.
+    """
+
+    ann_image = draw_points_on_image(image, all_points, all_labels)
+
     # Convert the annotated image to a downloadable JPEG format
     image_buffer = io.BytesIO()
     ann_image.save(image_buffer, format="PNG")
@@ -186,10 +241,180 @@ def update_ann_image(session_state, all_points, all_labels, image):
     session_state['ann_image'] = image_buffer
 
 
+def points_in_region(all_points, region):
+    """
+    Finds which points fall inside a rectangle or polygon region. Points on
+    the border of the region are counted as inside.
+
+    Args:
+        all_points (list of tuples): Points [(x1, y1), (x2, y2), ...].
+        region: Either a rectangle given as (x0, y0, x1, y1) or a polygon
+            given as a list of (x, y) vertices.
+
+    Returns:
+        np.ndarray: Boolean array, True for the points inside the region.
+    """
+    points = np.array(list(all_points), dtype=float).reshape(-1, 2)
+
+    if len(region) == 4 and np.ndim(region[0]) == 0:
+        x0, y0, x1, y1 = region
+        x_min, x_max = min(x0, x1), max(x0, x1)
+        y_min, y_max = min(y0, y1), max(y0, y1)
+        return (
+            (points[:, 0] >= x_min) & (points[:, 0] <= x_max) &
+            (points[:, 1] >= y_min) & (points[:, 1] <= y_max)
+        )
+
+    if len(points) == 0 or len(region) < 3:
+        return np.zeros(len(points), dtype=bool)
+
+    # The sign of the radius that grows the polygon (and so includes its
+    # border) depends on the orientation of the vertices
+    vertices = np.asarray(region, dtype=float)
+    x, y = vertices[:, 0], vertices[:, 1]
+    signed_area = np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y)
+    radius = 1e-9 if signed_area >= 0 else -1e-9
+
+    return Path(vertices).contains_points(points, radius=radius)
+
+
+def count_region(all_points, all_labels, region):
+    """
+    Counts the points inside a region, per label.
+
+    Returns:
+        dict: Number of points inside the region for each label in `label_list`.
+    """
+    points = list(all_points)
+    inside = points_in_region(points, region)
+    labels = np.array([all_labels[point] for point in points], dtype=int)
+    counts = np.bincount(labels[inside], minlength=len(label_list))
+
+    return {label_list[i]: int(counts[i]) for i in range(len(label_list))}
+
+
+def relabel_region(all_points, all_labels, region, label_id):
+    """
+    Assigns `label_id` to all the points inside a region.
+    """
+    points = list(all_points)
+    inside = points_in_region(points, region)
+    labels = np.array([all_labels[point] for point in points], dtype=int)
+    labels[inside] = label_id
+
+    return set(points), dict(zip(points, labels.tolist()))
+
+
+def delete_region(all_points, all_labels, region):
+    """
+    Removes all the points inside a region.
+    """
+    points = list(all_points)
+    keep = ~points_in_region(points, region)
+    kept_points = list(compress(points, keep))
+
+    return set(kept_points), {point: all_labels[point] for point in kept_points}
+
+
+region_operations = {
+    'relabel': relabel_region,
+    'delete': delete_region,
+    'count': count_region,
+}
+
+
+def apply_region_operation(session_state, all_points, all_labels, region, operation, image, file_name, label_id=None):
+    """
+    Applies a bulk operation ('relabel', 'delete' or 'count') over a region
+    and then persists and renders the results once.
+
+    Returns:
+        The updated all_points and all_labels, and the per-label counts for 'count'.
+    """
+    if operation not in region_operations:
+        raise ValueError(f"Unknown region operation: {operation}")
+
+    if operation == 'count':
+        return all_points, all_labels, count_region(all_points, all_labels, region)
+
+    # Points in the region and their labels before the operation
+    points = list(all_points)
+    region_labels = {point: all_labels[point] for point in compress(points, points_in_region(points, region))}
+
+    if operation == 'relabel':
+        all_points, all_labels = relabel_region(all_points, all_labels, region, label_id)
+        removed = {point: label for point, label in region_labels.items() if label != label_id}
+        record_point_changes(session_state, {point: label_id for point in removed}, removed)
+    else:
+        all_points, all_labels = delete_region(all_points, all_labels, region)
+        record_point_changes(session_state, {}, region_labels)
+
+    session_state['all_points'] = all_points
+    session_state['all_labels'] = all_labels
+
+    update_patch_data(session_state, all_points, all_labels)
+    update_results(session_state, all_points, all_labels, file_name)
+    update_ann_image(session_state, all_points, all_labels, image)
+
+    return all_points, all_labels, None
+
+
+def handle_component_value(session_state, new_labels, all_points, all_labels, image, file_name):
+    """
+    Incorporates the value returned by pointdet: either the full list of
+    points or, in the region modes, a region operation.
+    """
+    if new_labels is None:
+        return all_points, all_labels
+
+    if isinstance(new_labels, dict):
+        # The component keeps its last value between reruns, apply each region once
+        if session_state.get('last_region') == new_labels:
+            return all_points, all_labels
+        session_state['last_region'] = new_labels
+
+        vertices = new_labels['region']
+        if new_labels['shape'] == 'polygon':
+            region = [tuple(v) for v in vertices]
+        else:
+            region = (*vertices[0], *vertices[1])
+
+        all_points, all_labels, counts = apply_region_operation(
+            session_state, all_points, all_labels, region,
+            mode_region_operations[new_labels['mode']], image, file_name,
+            label_id=new_labels['label_id'],
+        )
+        session_state['region_counts'] = counts
+        return all_points, all_labels
+
+    # Incorporate the new labels
+    all_points, all_labels = update_annotations(new_labels, all_points, all_labels, session_state)
+    session_state['region_counts'] = None
+
+    # Update results
+    update_results(session_state, all_points, all_labels, file_name)
+    update_ann_image(session_state, all_points, all_labels, image)
+
+    return all_points, all_labels
+
+
+def show_region_counts(session_state):
+
+    counts = session_state.get('region_counts')
+    if counts is None:
+        return
+
+    st.sidebar.header("Conteo en región")
+    with st.sidebar:
+        for label, count in counts.items():
+            st.write(f"{label}: {count}")
+
+
 def recover_session(session_state, all_points, all_labels, image, file_name):
 
     session_state['all_points'] = all_points 
     session_state['all_labels'] = all_labels 
+    record_point_changes(session_state, None, None)
 
     update_patch_data(session_state, all_points, all_labels)
     update_results(session_state, all_points, all_labels, file_name)
@@ -279,6 +504,146 @@ def read_results_from_csv(csv_filename):
     return all_points, all_labels
 
 
+def find_image_file(base_name, folder_path="./images"):
+    """
+    Returns the path of the image whose name (without extension) is `base_name`,
+    or None if there is no such image in the folder.
+    """
+    for f in sorted(os.listdir(folder_path)):
+        if os.path.splitext(f)[0] == base_name and os.path.isfile(os.path.join(folder_path, f)):
+            return os.path.join(folder_path, f)
+
+    return None
+
+
+def list_annotated_images():
+    """
+    Returns the names (without extension) of all the images with stored annotations.
+    """
+    return sorted(
+        os.path.splitext(f)[0]
+        for f in os.listdir(ann_dir)
+        if f.endswith(".csv")
+    )
+
+
+def write_coco_points(text_file, image_file_name, image_size, all_points, all_labels):
+    """
+    Writes the points of one image as a COCO keypoint file, one annotation at a time.
+    """
+    width, height = image_size
+    text_file.write('{"images": ')
+    text_file.write(json.dumps([{"id": 1, "file_name": image_file_name, "width": width, "height": height}]))
+    text_file.write(', "categories": ')
+    text_file.write(json.dumps([{"id": i + 1, "name": name} for i, name in enumerate(label_list)]))
+    text_file.write(', "annotations": [')
+
+    for ann_id, point in enumerate(all_points, start=1):
+        x, y = point
+        annotation = {
+            "id": ann_id,
+            "image_id": 1,
+            "category_id": all_labels[point] + 1,
+            "keypoints": [x, y, 2],
+            "num_keypoints": 1,
+            "bbox": [x, y, 0, 0],
+            "area": 0,
+            "iscrowd": 0,
+        }
+        if ann_id > 1:
+            text_file.write(", ")
+        text_file.write(json.dumps(annotation))
+
+    text_file.write("]}")
+
+
+def write_geojson_points(text_file, all_points, all_labels):
+    """
+    Writes the points of one image as a GeoJSON FeatureCollection in pixel
+    coordinates, one feature at a time.
+    """
+    text_file.write('{"type": "FeatureCollection", "features": [')
+
+    for idx, point in enumerate(all_points):
+        feature = {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": list(point)},
+            "properties": {"label": label_list[all_labels[point]], "label_id": all_labels[point]},
+        }
+        if idx > 0:
+            text_file.write(", ")
+        text_file.write(json.dumps(feature))
+
+    text_file.write("]}")
+
+
+def export_bundle(base_names, zip_path, include_coco=False, include_geojson=False):
+    """
+    Writes the CSV annotations, report, annotated image and optionally the
+    COCO/GeoJSON points of each image into a zip file on disk.
+
+    Artifacts are written straight into the archive one image at a time, so
+    only the current image and its annotations are kept in memory. Images
+    without annotations are skipped; for images whose file is missing only
+    the annotations, the report and the GeoJSON points are written.
+
+    Args:
+        base_names (list): Names (without extension) of the images to export.
+        zip_path (str): Path of the zip file to create.
+        include_coco (bool): Whether to add a COCO keypoints file per image.
+        include_geojson (bool): Whether to add a GeoJSON file per image.
+
+    Returns:
+        tuple: A tuple containing:
+            - missing_annotations (list): Names skipped because they have no CSV annotations.
+            - missing_images (list): Names whose image file was not found.
+    """
+    os.makedirs(os.path.dirname(zip_path) or ".", exist_ok=True)
+
+    missing_annotations = []
+    missing_images = []
+
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+        for base_name in base_names:
+            csv_filename = f"{ann_dir}/{base_name}.csv"
+            report_filename = f"{report_dir}/{base_name}.txt"
+
+            if not os.path.isfile(csv_filename):
+                missing_annotations.append(base_name)
+                continue
+
+            zip_file.write(csv_filename, f"{base_name}/{base_name}.csv")
+            if os.path.isfile(report_filename):
+                zip_file.write(report_filename, f"{base_name}/{base_name}.txt")
+
+            all_points, all_labels = read_results_from_csv(csv_filename)
+
+            image_path = find_image_file(base_name, image_dir)
+            image_size = None
+            if image_path is None:
+                missing_images.append(base_name)
+            else:
+                with Image.open(image_path) as image:
+                    image_size = image.size
+                    ann_image = draw_points_on_image(image, all_points, all_labels)
+                with zip_file.open(f"{base_name}/{base_name}_annotated.png", "w") as png_file:
+                    ann_image.save(png_file, format="PNG")
+                del ann_image
+
+            # COCO needs the image size, so it is skipped when the image is missing
+            if include_coco and image_size is not None:
+                with zip_file.open(f"{base_name}/{base_name}_coco.json", "w") as raw_file:
+                    with io.TextIOWrapper(raw_file, encoding="utf-8") as text_file:
+                        write_coco_points(text_file, os.path.basename(image_path), image_size, all_points, all_labels)
+
+            if include_geojson:
+                with zip_file.open(f"{base_name}/{base_name}.geojson", "w") as raw_file:
+                    with io.TextIOWrapper(raw_file, encoding="utf-8") as text_file:
+                        write_geojson_points(text_file, all_points, all_labels)
+
+    return missing_annotations, missing_images
+
+
 def get_image():
 
     image = None     
@@ -352,6 +717,11 @@ def image_ann(session_state):
         with col2:
             session_state['label'] = st.selectbox("Clase:", label_list)
 
+        if REGION_MODES:
+            session_state['region_shape'] = st.selectbox("Región:", region_shapes)
+        else:
+            session_state['region_shape'] = region_shapes[0]
+
 
     image, image_file_name, img_path = get_image()
 
@@ -366,11 +736,7 @@ def image_ann(session_state):
             all_labels = session_state['all_labels']
 
             # Translate the selected action
-            action = session_state['action']
-            if action == actions[1]:
-                mode = 'Del'
-            else:
-                mode = 'Transform'
+            mode = action_modes[session_state['action']]
 
 
         # User got disconnected - We recover the previous session
@@ -399,18 +765,14 @@ def image_ann(session_state):
             label = session_state['label'],
             point_width=5,
             zoom=zoom,
+            region_shape = 'polygon' if session_state['region_shape'] == region_shapes[1] else 'rect',
         )
         
         # Update points and labels in session state if any changes are made
-        if new_labels is not None:
-
-            # Incorporate the new labels
-            all_points, all_labels = update_annotations(new_labels, all_points, all_labels, session_state)
+        base_name = os.path.splitext(image_file_name)[0]
+        all_points, all_labels = handle_component_value(session_state, new_labels, all_points, all_labels, image, base_name)
 
-            # Update results
-            base_name = os.path.splitext(image_file_name)[0]
-            update_results(session_state, all_points, all_labels, base_name)
-            update_ann_image(session_state, all_points, all_labels, image)
+        show_region_counts(session_state)
 
 
 
@@ -441,4 +803,58 @@ def image_ann(session_state):
                 data=session_state['ann_image'],
                 file_name=f'{image_name}_annotated.png',
                 mime='image/png'
-            )
\ No newline at end of file
+            )
+
+        # Bundle export of one or several images
+        st.sidebar.header("Exportar paquete")
+        with st.sidebar:
+            annotated_images = list_annotated_images()
+            bundle_images = st.multiselect(
+                "Imágenes:",
+                annotated_images,
+                default=[image_name] if image_name in annotated_images else [],
+            )
+            include_coco = st.checkbox("Incluir COCO (json)")
+            include_geojson = st.checkbox("Incluir GeoJSON")
+
+            # The zip is only built and handed to Streamlit in the run where it is
+            # requested, and removed from disk right after. Streamlit still keeps
+            # that one archive in memory until the next rerun.
+            if st.button("Generar paquete (zip)") and len(bundle_images) > 0:
+                os.makedirs(export_dir, exist_ok=True)
+                fd, bundle_path = tempfile.mkstemp(suffix=".zip", dir=export_dir)
+                os.close(fd)
+
+                try:
+                    missing_annotations, missing_images = export_bundle(
+                        bundle_images,
+                        bundle_path,
+                        include_coco=include_coco,
+                        include_geojson=include_geojson,
+                    )
+
+                    if len(missing_annotations) > 0:
+                        st.warning(f"Sin anotaciones, no se exportaron: {', '.join(missing_annotations)}")
+                    if len(missing_images) > 0:
+                        st.warning(
+                            f"No se encontró la imagen, se exportaron sin imagen anotada"
+                            f"{' ni COCO' if include_coco else ''}: {', '.join(missing_images)}"
+                        )
+
+                    exported_images = [name for name in bundle_images if name not in missing_annotations]
+
+                    if len(exported_images) > 0:
+                        if len(exported_images) == 1:
+                            bundle_name = f"{exported_images[0]}_bundle.zip"
+                        else:
+                            bundle_name = f"bundle_{len(exported_images)}_imagenes.zip"
+
+                        with open(bundle_path, "rb") as bundle_file:
+                            st.download_button(
+                                label="Descargar paquete (zip)",
+                                data=bundle_file,
+                                file_name=bundle_name,
+                                mime='application/zip'
+                            )
+                finally:
+                    os.remove(bundle_path)
\ No newline at end of file
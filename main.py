@@ -5,6 +5,7 @@ from image_annotation import *
 image_dir  = "./images"
 ann_dir    = "./annotations"
 report_dir = "./reports"
+export_dir = "./exports"
 
 app_list = ["Anotación de imágenes", "Corrección de anotaciones", "Corrección de máscaras"]
 
@@ -10,12 +10,26 @@ import matplotlib.pyplot as plt
 from hashlib import md5
 from streamlit_image_annotation import IS_RELEASE
 
+def _build_has_region_modes(build_path):
+    # The region modes are only available once the frontend is rebuilt with them
+    js_path = os.path.join(build_path, "static", "js")
+    if not os.path.isdir(js_path):
+        return False
+    for f in os.listdir(js_path):
+        if f.startswith("main.") and f.endswith(".js"):
+            with open(os.path.join(js_path, f), encoding="utf-8") as js_file:
+                if "DelRegion" in js_file.read():
+                    return True
+    return False
+
 if IS_RELEASE:
     absolute_path = os.path.dirname(os.path.abspath(__file__))
     build_path = os.path.join(absolute_path, "frontend/build")
     _component_func = components.declare_component("st_point", path=build_path)
+    REGION_MODES = _build_has_region_modes(build_path)
 else:
     _component_func = components.declare_component("st_point", url="http://localhost:3000")
+    REGION_MODES = True
 
 def get_colormap(label_names, colormap_name='gist_rainbow'):
     colormap = {} 
@@ -25,7 +39,7 @@ def get_colormap(label_names, colormap_name='gist_rainbow'):
         colormap[l] = ('#%02x%02x%02x' % tuple(rgb))
     return colormap
 
-def pointdet(image_path, label_list, points=None, labels=None, height=512, width=512, point_width=3, use_space=False, key=None, mode=None, label=None, zoom=2) -> CustomComponent:
+def pointdet(image_path, label_list, points=None, labels=None, height=512, width=512, point_width=3, use_space=False, key=None, mode=None, label=None, zoom=2, region_shape='rect') -> CustomComponent:
     image = Image.open(image_path)
     original_image_size = image.size
     image.thumbnail(size=(width, height))
@@ -38,8 +52,11 @@ def pointdet(image_path, label_list, points=None, labels=None, height=512, width
 
     color_map = get_colormap(label_list, colormap_name='gist_rainbow')
     points_info = [{'point':[b/scale for b in item[0]], 'label_id': item[1], 'label': label_list[item[1]]} for item in zip(points, labels)]
-    component_value = _component_func(image_url=image_url, image_size=image.size, label_list=label_list, points_info=points_info, color_map=color_map, point_width=point_width, use_space=use_space, key=key, mode=mode, label=label, zoom=zoom)
-    if component_value is not None:
+    component_value = _component_func(image_url=image_url, image_size=image.size, label_list=label_list, points_info=points_info, color_map=color_map, point_width=point_width, use_space=use_space, key=key, mode=mode, label=label, zoom=zoom, region_shape=region_shape, image_scale=scale)
+    if isinstance(component_value, dict):
+        # Region operation: {'mode', 'shape', 'region': [[x, y], ...], 'label_id'}
+        component_value = {**component_value, 'region': [[b*scale for b in v] for v in component_value['region']]}
+    elif component_value is not None:
         component_value = [{'point':[b*scale for b in item['point']], 'label_id': item['label_id'], 'label': item['label']}for item in component_value]
     return component_value
 
@@ -16,11 +16,12 @@ export interface BBoxProps {
   isSelected: boolean,
   onClick: any,
   scale: number,
-  strokeWidth: number
+  strokeWidth: number,
+  listening?: boolean
 }
 const Point = (props: BBoxProps)=>{
   const {
-    rectProps, onChange, isSelected, onClick, scale, strokeWidth
+    rectProps, onChange, isSelected, onClick, scale, strokeWidth, listening = true
   }: BBoxProps = props
 
   return (
@@ -33,6 +34,7 @@ const Point = (props: BBoxProps)=>{
         width={strokeWidth*2}
         height={strokeWidth*2}
         draggable={isSelected}
+        listening={listening}
         strokeWidth={isSelected?strokeWidth*3:strokeWidth}
         onDragEnd={(e) => {
           onChange({
@@ -1,5 +1,5 @@
-import React, { useEffect } from "react"
-import { Layer, Stage, Image } from 'react-konva';
+import React, { useEffect, useState } from "react"
+import { Layer, Stage, Image, Line, Text } from 'react-konva';
 import Point from './Point'
 import Konva from 'konva';
 
@@ -17,6 +17,48 @@ export interface PointCanvasProps {
   image: any,
   strokeWidth: number
   zoom: number
+  regionShape: string
+  imageScale: number
+  onRegion: any
+}
+
+const regionModes = ['Relabel', 'DelRegion', 'Count']
+
+// Checks if a point lies on the segment between (xi, yi) and (xj, yj)
+const isOnSegment = (x: number, y: number, xi: number, yi: number, xj: number, yj: number) => {
+  const length = Math.hypot(xj - xi, yj - yi)
+  if (length === 0) {
+    return Math.hypot(x - xi, y - yi) <= 1e-9
+  }
+  const cross = (xj - xi) * (y - yi) - (yj - yi) * (x - xi)
+  return Math.abs(cross) / length <= 1e-9 &&
+    x >= Math.min(xi, xj) - 1e-9 && x <= Math.max(xi, xj) + 1e-9 &&
+    y >= Math.min(yi, yj) - 1e-9 && y <= Math.max(yi, yj) + 1e-9
+}
+
+// Checks if a point lies inside a rectangle [x0, y0, x1, y1] or a polygon [x0, y0, x1, y1, ...].
+// Points on the border are inside, as in points_in_region on the Python side.
+const isInsideRegion = (x: number, y: number, region: number[], regionShape: string) => {
+  if (regionShape !== 'polygon') {
+    const [x0, y0, x1, y1] = region
+    return x >= Math.min(x0, x1) && x <= Math.max(x0, x1) && y >= Math.min(y0, y1) && y <= Math.max(y0, y1)
+  }
+  const n = region.length / 2
+  if (n < 3) {
+    return false
+  }
+  let inside = false
+  for (let i = 0, j = n - 1; i < n; j = i++) {
+    const xi = region[2 * i], yi = region[2 * i + 1]
+    const xj = region[2 * j], yj = region[2 * j + 1]
+    if (isOnSegment(x, y, xi, yi, xj, yj)) {
+      return true
+    }
+    if ((yi > y) !== (yj > y) && x < (xj - xi) * (y - yi) / (yj - yi) + xi) {
+      inside = !inside
+    }
+  }
+  return inside
 }
 
 const PointCanvas = (props: PointCanvasProps) => {
@@ -33,8 +75,76 @@ const PointCanvas = (props: PointCanvasProps) => {
     image_size,
     image,
     strokeWidth,
-    zoom
+    zoom,
+    regionShape,
+    imageScale,
+    onRegion
   }: PointCanvasProps = props
+
+  const [region, setRegion] = useState<number[] | null>(null)
+  const [isDrawing, setIsDrawing] = useState(false)
+  const [regionCount, setRegionCount] = useState<string | null>(null)
+  const isRegionMode = regionModes.includes(mode)
+
+  useEffect(() => {
+    setRegion(null)
+    setRegionCount(null)
+  }, [mode, regionShape])
+
+  const getPointer = (e: any) => {
+    const pointer = e.target.getStage().getPointerPosition()
+    return [pointer.x / (scale*zoom), pointer.y / (scale*zoom)]
+  }
+
+  const startRegion = (e: any) => {
+    const [x, y] = getPointer(e)
+    setRegion(regionShape === 'polygon' ? [x, y] : [x, y, x, y])
+    setRegionCount(null)
+    setIsDrawing(true)
+  }
+
+  const extendRegion = (e: any) => {
+    if (!isDrawing || region === null) {
+      return
+    }
+    const [x, y] = getPointer(e)
+    setRegion(regionShape === 'polygon' ? region.concat([x, y]) : [region[0], region[1], x, y])
+  }
+
+  // Applies the selected bulk operation to all the points in the region with a single update,
+  // and sends the region to Python so it applies the same operation
+  const finishRegion = () => {
+    if (!isDrawing || region === null) {
+      return
+    }
+    setIsDrawing(false)
+    onRegion(region, mode !== 'Count')
+
+    // Test the points as Python stores them: truncated to integers in the original image scale
+    const scaledRegion = region.map((v) => v * imageScale)
+    const inside = pointsInfo.map((point) => isInsideRegion(
+      Math.trunc(point.x * imageScale), Math.trunc(point.y * imageScale), scaledRegion, regionShape
+    ))
+
+    if (mode === 'Relabel') {
+      setPointsInfo(pointsInfo.map((point, i) => inside[i] ? { ...point, label: label, stroke: color_map[label] } : point))
+      setRegion(null)
+    } else if (mode === 'DelRegion') {
+      setPointsInfo(pointsInfo.filter((point, i) => !inside[i]))
+      setRegion(null)
+    } else if (mode === 'Count') {
+      const counts: { [key: string]: number } = {}
+      pointsInfo.forEach((point, i) => {
+        if (inside[i]) {
+          counts[point.label] = (counts[point.label] || 0) + 1
+        }
+      })
+      const total = inside.filter(Boolean).length
+      setRegionCount(
+        [`Total: ${total}`].concat(Object.keys(counts).map((l) => `${l}: ${counts[l]}`)).join('\n')
+      )
+    }
+  }
   
   const checkDeselect = (e: any) => {
     if (!(e.target instanceof Konva.Circle)) {
@@ -78,7 +188,9 @@ const PointCanvas = (props: PointCanvasProps) => {
       <Stage 
         width={image_size[0] * (scale*zoom)}
         height={image_size[1] * (scale*zoom)}
-        onMouseDown={checkDeselect}
+        onMouseDown={isRegionMode ? startRegion : checkDeselect}
+        onMouseMove={isRegionMode ? extendRegion : undefined}
+        onMouseUp={isRegionMode ? finishRegion : undefined}
       >
         <Layer>
           <Image image={image} scaleX={(scale*zoom)} scaleY={(scale*zoom)} />
@@ -92,6 +204,7 @@ const PointCanvas = (props: PointCanvasProps) => {
                 scale={(scale*zoom)}
                 strokeWidth={strokeWidth}
                 isSelected={mode === 'Transform' && point.id === selectedId}
+                listening={!isRegionMode}
                 onClick={() => {
                   if (mode === 'Transform') {
                     setSelectedId(point.id);
@@ -116,6 +229,31 @@ const PointCanvas = (props: PointCanvasProps) => {
             );
           })}
         </Layer>
+        {region !== null && (
+          <Layer listening={false}>
+            <Line
+              points={
+                regionShape === 'polygon'
+                  ? region.map((v) => v * (scale*zoom))
+                  : [region[0], region[1], region[2], region[1], region[2], region[3], region[0], region[3]].map((v) => v * (scale*zoom))
+              }
+              closed={true}
+              stroke={'#ffffff'}
+              strokeWidth={1}
+              dash={[6, 4]}
+            />
+            {regionCount !== null && (
+              <Text
+                x={Math.min(...region.filter((v, i) => i % 2 === 0)) * (scale*zoom)}
+                y={Math.min(...region.filter((v, i) => i % 2 === 1)) * (scale*zoom)}
+                text={regionCount}
+                fill={'#ffffff'}
+                fontSize={14}
+                padding={4}
+              />
+            )}
+          </Layer>
+        )}
       </Stage>
     </div>
   );
@@ -20,7 +20,9 @@ export interface PythonArgs {
   use_space: boolean,
   mode: string,   // <-- Added "mode" to the Python arguments
   label: string,  // <-- Added "label" to the Python arguments
-  zoom: number
+  zoom: number,
+  region_shape: string,
+  image_scale: number
 }
 const PointDet = ({ args, theme }: ComponentProps) => {
   const {
@@ -33,7 +35,9 @@ const PointDet = ({ args, theme }: ComponentProps) => {
     use_space,
     mode,  // <-- Extract "mode" from the args
     label,  // <-- Extract "label" from the args
-    zoom
+    zoom,
+    region_shape,
+    image_scale
   }: PythonArgs = args
 
   const params = new URLSearchParams(window.location.search);
@@ -53,6 +57,23 @@ const PointDet = ({ args, theme }: ComponentProps) => {
 
   const [selectedId, setSelectedId] = React.useState<string | null>(null);
 
+  // Set when a region operation was already sent, so the resulting points update is not sent again
+  const skipNextValue = React.useRef(false)
+
+  const sendRegion = (region: number[], changesPoints: boolean) => {
+    const vertices = []
+    for (let i = 0; i < region.length; i += 2) {
+      vertices.push([region[i], region[i + 1]])
+    }
+    skipNextValue.current = changesPoints
+    Streamlit.setComponentValue({
+      mode: mode,
+      shape: region_shape === 'polygon' ? 'polygon' : 'rect',
+      region: vertices,
+      label_id: label_list.indexOf(label)
+    })
+  }
+
   const [scale, setScale] = useState(1.0)
   useEffect(() => {
     const resizeCanvas = () => {
@@ -86,6 +107,10 @@ const PointDet = ({ args, theme }: ComponentProps) => {
   // This effect runs only when pointsInfo changes
   useEffect(() => {
     // Only set the component value when pointsInfo changes
+    if (skipNextValue.current) {
+      skipNextValue.current = false
+      return
+    }
     const currentPointsValue = pointsInfo.map((point, i) => {
       return {
         point: [point.x, point.y],
@@ -124,6 +149,9 @@ const PointDet = ({ args, theme }: ComponentProps) => {
                 image_size={image_size}
                 strokeWidth={point_width}
                 zoom={zoom}
+                regionShape={region_shape}
+                imageScale={image_scale}
+                onRegion={sendRegion}
               />
             </Box>
           </HStack>
@@ -1,3 +1,3 @@
 IS_RELEASE = True
 
-from .Point import pointdet
\ No newline at end of file
+from .Point import pointdet, REGION_MODES
\ No newline at end of file
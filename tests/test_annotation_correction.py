@@ -0,0 +1,19 @@
+import numpy as np
+import cv2
+from PIL import Image
+
+from annotation_correction import overlay_masks_on_image
+
+
+def test_tiled_overlay_matches_single_tile_for_mask_with_hole():
+    # Ring mask: the tile edges cross the hole
+    ring = np.zeros((200, 200), dtype=np.uint8)
+    cv2.circle(ring, (100, 100), 60, 1, -1)
+    cv2.circle(ring, (100, 100), 30, 0, -1)
+    image = Image.new("RGB", (200, 200))
+
+    for thickness in (1, 3, 5):
+        single = overlay_masks_on_image(image, [ring.astype(bool)], thickness=thickness, tile_size=1000)
+        tiled = overlay_masks_on_image(image, [ring.astype(bool)], thickness=thickness, tile_size=100)
+
+        assert np.array_equal(np.asarray(single), np.asarray(tiled))